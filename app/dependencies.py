@@ -1,29 +1,166 @@
 from typing import Annotated
-from fastapi import Depends, UploadFile, HTTPException
-import json
-import requests
+from fastapi import BackgroundTasks, Depends, UploadFile, HTTPException, Request
+import orjson
+import httpx
 import os
 import cv2
-import tempfile
-from supabase import create_client, Client
+import numpy as np
+import asyncio
+import logging
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+from supabase import AsyncClient
 
 
+logger = logging.getLogger(__name__)
 
+# Parallelism comes from uvicorn workers and the per-worker image pool, so keep
+# OpenCV from spawning its own threads inside every pool thread
+cv2.setNumThreads(1)
 
+# Read configuration once at import time; a missing variable fails startup
+# instead of every request
+ULTRALYTICS_API_KEY = os.environ["ULTRALYTICS_API_KEY"]
+ULTRALYTICS_MODEL_URL = os.environ["ULTRALYTICS_MODEL_URL"]
+ULTRALYTICS_INFERENCE_URL = os.environ["ULTRALYTICS_INFERENCE_URL"]
+ULTRALYTICS_MAX_CONCURRENCY = int(os.getenv("ULTRALYTICS_MAX_CONCURRENCY", "8"))
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", "2"))
+SUPABASE_URL = os.environ["SUPABASE_URL"]
+SUPABASE_KEY = os.environ["SUPABASE_KEY"]
+SUPABASE_STORAGE_BUCKET = os.environ["SUPABASE_STORAGE_BUCKET"]
 
-async def run_inference(file: UploadFile):
+# storage3 uploads to the object path unescaped, so anything outside this set
+# (spaces, '#', '?', '%', ...) is replaced to keep the upload path and the
+# public URL identical
+UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+SUPABASE_PUBLIC_URL_PREFIX = f"{SUPABASE_URL.rstrip('/')}/storage/v1/object/public/{SUPABASE_STORAGE_BUCKET}"
+
+# Upstream responses worth retrying (the request was turned away, not run), and
+# how hard to try. 502/504 are left out: a gateway may already have forwarded
+# the POST to a backend that ran and billed it.
+RETRY_STATUS_CODES = {429, 503}
+ULTRALYTICS_MAX_ATTEMPTS = 4
+
+# Quality 85 with Huffman optimisation is visually indistinguishable for the
+# annotated output but far smaller than OpenCV's default of 95
+JPEG_ENCODE_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), 85, int(cv2.IMWRITE_JPEG_OPTIMIZE), 1]
+
+
+def _is_supported_image(file_content: bytes) -> bool:
+    # Sniff the magic bytes for JPEG, PNG and WebP
+    return (
+        file_content[:3] == b"\xff\xd8\xff"
+        or file_content[:8] == b"\x89PNG\r\n\x1a\n"
+        or (file_content[:4] == b"RIFF" and file_content[8:12] == b"WEBP")
+    )
+
+
+def _decode_image(file_content: bytes):
+    arr = np.frombuffer(file_content, dtype=np.uint8)
+    return cv2.imdecode(arr, cv2.IMREAD_COLOR)
+
+
+def _extract_boxes(result: dict) -> list[tuple[int, int, int, int]]:
+    # Check if the result contains the expected data structure
+    images = result.get("images")
+    if not images:
+        raise Exception("No images found in the result")
+    
+    detections = images[0].get("results") or []
+    if not detections:
+        # No detection results, return the original image
+        logger.debug("No detection results found in the API response")
+    
+    # Collect the bounding box of every detection
+    boxes = []
+    for detection in detections:
+        try:
+            box = detection["box"]
+            boxes.append((int(box["x1"]), int(box["y1"]), int(box["x2"]), int(box["y2"])))
+        except (KeyError, IndexError, TypeError, ValueError):
+            # Missing or malformed box coordinates, skip this detection
+            logger.debug("Missing box coordinates in the API response: %s", detection)
+    return boxes
+
+
+def _annotate_image(image, boxes: list[tuple[int, int, int, int]]) -> bytes:
+    # Draw a rectangle for every detection in a single pass
+    for x1, y1, x2, y2 in boxes:
+        cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 2)
+    
+    # Convert the image to bytes directly without saving to disk
+    _, buffer = cv2.imencode('.jpg', image, JPEG_ENCODE_PARAMS)
+    return buffer.tobytes()
+
+
+def _retry_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    # Honour the upstream's Retry-After (in seconds) when it gives one
+    if response is not None:
+        try:
+            return max(0.0, min(float(response.headers["retry-after"]), 30.0))
+        except (KeyError, ValueError):
+            pass
+    # Otherwise exponential backoff from 0.3s, capped at 5s, with jitter
+    return min(0.3 * 2 ** attempt, 5.0) + random.uniform(0, 0.3)
+
+
+async def _post_with_retries(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    data: dict,
+    files: dict
+) -> httpx.Response:
+    # Send the inference request, capping how many are in flight to Ultralytics
+    # at once. Only failures where the upstream did not run the model are retried:
+    # 429/503 responses and connections that were never established. Gateway
+    # errors (502/504) and read or protocol errors are not retried because the
+    # request may already have been processed (and billed).
+    for attempt in range(ULTRALYTICS_MAX_ATTEMPTS):
+        last_attempt = attempt == ULTRALYTICS_MAX_ATTEMPTS - 1
+        try:
+            async with semaphore:
+                response = await client.post(
+                    ULTRALYTICS_INFERENCE_URL,
+                    data=data,
+                    files=files
+                )
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            if last_attempt:
+                raise
+            delay = _retry_delay(attempt)
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or last_attempt:
+                response.raise_for_status()
+                return response
+            delay = _retry_delay(attempt, response)
+        # Transient failure: back off (outside the semaphore) and try again
+        logger.debug("Retrying Ultralytics request in %.2fs (attempt %d)", delay, attempt + 1)
+        await asyncio.sleep(delay)
+
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.http_client
+
+
+def get_image_pool(request: Request) -> ThreadPoolExecutor:
+    return request.app.state.image_pool
+
+
+def get_ultralytics_semaphore(request: Request) -> asyncio.Semaphore:
+    return request.app.state.ultralytics_semaphore
+
+
+async def run_inference(
+    file: UploadFile,
+    client: httpx.AsyncClient = Depends(get_http_client),
+    image_pool: ThreadPoolExecutor = Depends(get_image_pool),
+    ultralytics_semaphore: asyncio.Semaphore = Depends(get_ultralytics_semaphore)
+):
     try:
-        # Validate API key and required environment variables
-        api_key = os.getenv("ULTRALYTICS_API_KEY")
-        model_url = os.getenv("ULTRALYTICS_MODEL_URL")
-        inference_url = os.getenv("ULTRALYTICS_INFERENCE_URL")
-        
-        if not all([api_key, model_url, inference_url]):
-            raise HTTPException(status_code=500, detail="Missing required environment variables")
-        
-        # Set up request parameters
-        headers = {"x-api-key": api_key}
-        data = {"model": model_url, "imgsz": 640, "conf": 0.25, "iou": 0.45}
+        # Set up request parameters (the x-api-key header is preset on the shared client)
+        data = {"model": ULTRALYTICS_MODEL_URL, "imgsz": 640, "conf": 0.25, "iou": 0.45}
         
         # Read the file content
         try:
@@ -35,105 +172,53 @@ async def run_inference(file: UploadFile):
         if not file_content:
             raise HTTPException(status_code=400, detail="Empty file provided")
         
+        # Reject non-images before spending an Ultralytics call and a decode on them
+        if not _is_supported_image(file_content):
+            raise HTTPException(status_code=415, detail="Unsupported image type")
+        
         # Properly format the file for the API request
         files = {
             "file": (file.filename, file_content, file.content_type)
         }
         
-        # Make the API request
+        # Decode the image in a worker thread while waiting on the API response
+        decode_task = asyncio.get_running_loop().run_in_executor(image_pool, _decode_image, file_content)
         try:
-            response = requests.post(
-                inference_url,
-                headers=headers,
-                data=data,
-                files=files
+            # Collect both outcomes so a decode error is never left unretrieved
+            # when the API call fails first
+            image, response = await asyncio.gather(
+                decode_task,
+                _post_with_retries(client, ultralytics_semaphore, data, files),
+                return_exceptions=True
             )
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
+            if isinstance(response, BaseException):
+                raise response
+            if isinstance(image, BaseException):
+                raise image
+        except httpx.HTTPStatusError as e:
             error_msg = str(e)
-            if response := getattr(e, 'response', None):
-                try:
-                    error_detail = response.json()
-                    error_msg = f"{error_msg}: {json.dumps(error_detail)}"
-                except (ValueError, json.JSONDecodeError):
-                    if response.text:
-                        error_msg = f"{error_msg}: {response.text}"
+            if e.response.text:
+                error_msg = f"{error_msg}: {e.response.text}"
             raise HTTPException(status_code=500, detail=f"Ultralytics API error: {error_msg}")
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=500, detail=f"Ultralytics API error: {str(e)}")
+        
+        if image is None:
+            raise HTTPException(status_code=400, detail="Invalid image")
         
         # Parse the response
         try:
-            result = response.json() 
-        except (ValueError, json.JSONDecodeError) as e:
+            result = orjson.loads(response.content)
+        except orjson.JSONDecodeError as e:
             raise HTTPException(status_code=500, detail=f"Error parsing API response: {str(e)}")
+        
         try:
-            # Save the file content to a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file.filename.split(".")[-1]}') as temp_file:
-                temp_file_path = temp_file.name
-                # Reset the file pointer to the beginning
-                await file.seek(0)
-                # Read the file content again
-                file_content = await file.read()
-                # Write to the temporary file
-                temp_file.write(file_content)
-            
-            # Read the image with OpenCV
-            image = cv2.imread(temp_file_path)
-            if image is None:
-                raise Exception(f"Failed to read image from {temp_file_path}")
+            boxes = _extract_boxes(result)
             
-            # Check if the result contains the expected data structure
-            if not result.get("images") or len(result["images"]) == 0:
-                raise Exception("No images found in the result")
-                
-            if not result["images"][0].get("results") or len(result["images"][0]["results"]) == 0:
-                # No detection results, return the original image
-                print("No detection results found in the API response")
-                # Clean up the temporary file
-                os.unlink(temp_file_path)
-                
-                # Convert the image to bytes directly without saving to disk
-                _, buffer = cv2.imencode('.jpg', image)
-                image_bytes = buffer.tobytes()
-                
-                return {
-                    "original_file": file,
-                    "image_bytes": image_bytes,
-                    "filename": file.filename
-                }
-                
-            # Get bounding box coordinates
-            box = result["images"][0]["results"][0].get("box", {})
-            if not box or not all(k in box for k in ["x1", "y1", "x2", "y2"]):
-                # Missing box coordinates, return the original image
-                print("Missing box coordinates in the API response")
-                # Clean up the temporary file
-                os.unlink(temp_file_path)
-                
-                # Convert the image to bytes directly without saving to disk
-                _, buffer = cv2.imencode('.jpg', image)
-                image_bytes = buffer.tobytes()
-                
-                return {
-                    "original_file": file,
-                    "image_bytes": image_bytes,
-                    "filename": file.filename
-                }
-            
-            x1 = int(box["x1"])
-            y1 = int(box["y1"])
-            x2 = int(box["x2"])
-            y2 = int(box["y2"])
-            
-            # Draw rectangle on image
-            cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            
-            # Clean up the temporary file
-            os.unlink(temp_file_path)
-            
-            # Convert the image to bytes directly without saving to disk
-            # Encode the image to the appropriate format (JPEG)
-            _, buffer = cv2.imencode('.jpg', image)
-            image_bytes = buffer.tobytes()
+            # Draw the boxes and encode to JPEG off the event loop
+            image_bytes = await asyncio.get_running_loop().run_in_executor(
+                image_pool, _annotate_image, image, boxes
+            )
             
             # Return the image bytes and filename for use in save_to_supabase_storage
             return {
@@ -149,43 +234,53 @@ async def run_inference(file: UploadFile):
         raise
     except Exception as e:
         # Catch any other unexpected errors
-        print(f"Unexpected error in run_inference: {str(e)}")
+        logger.exception("Unexpected error in run_inference")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
     
     
-def SupabaseClient() -> Client:
+def SupabaseClient(request: Request) -> AsyncClient:
+    return request.app.state.supabase
+
+
+def _storage_path(filename: str | None) -> str:
+    # A fresh uuid keeps the path unique; the filename is only kept for readability
+    safe_name = UNSAFE_FILENAME_CHARS.sub("_", filename or "image")
+    return f"inference/{uuid4().hex}_{safe_name}"
+
+
+async def _upload_to_supabase(supabase: AsyncClient, bucket_name: str, path: str, image_bytes: bytes):
     try:
-        url: str = os.getenv("SUPABASE_URL")
-        key: str = os.getenv("SUPABASE_KEY")
-        supabase: Client = create_client(url, key)    
-        return supabase
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error loading Supabase client: {str(e)}")
-    
-async def save_to_supabase_storage(inference_result: Annotated[dict, Depends(run_inference)], supabase: Client = Depends(SupabaseClient)):
+        await supabase.storage.from_(bucket_name).upload(
+            path=path,
+            file=image_bytes,
+            file_options={"cache-control": "3600", "content-type": "image/jpeg", "upsert": "false"}
+        )
+    except Exception:
+        # The response has already been sent, so the failure can only be reported here
+        logger.exception("Error saving image %s to Supabase", path)
+
+
+async def save_to_supabase_storage(
+    inference_result: Annotated[dict, Depends(run_inference)],
+    background_tasks: BackgroundTasks,
+    supabase: AsyncClient = Depends(SupabaseClient)
+):
     try:
         # Get the image bytes and filename from the inference result
         image_bytes = inference_result["image_bytes"]
         filename = inference_result["filename"]
         
-        # Upload the processed image bytes directly to Supabase
-        bucket_name = os.getenv("SUPABASE_STORAGE_BUCKET")
-        if not bucket_name:
-            raise HTTPException(status_code=500, detail="SUPABASE_STORAGE_BUCKET environment variable not set")
-            
-        response = (
-            supabase.storage
-            .from_(bucket_name)
-            .upload(
-                path=f"inference/output_{filename}",
-                file=image_bytes,
-                file_options={"cache-control": "3600", "upsert": "true"}
-            )
-        )
+        # The public URL only depends on the bucket and path, so it is built
+        # locally and returned before the upload has finished. The path is unique
+        # per request so the URL can never resolve to another request's image.
+        path = _storage_path(filename)
+        file_url = f"{SUPABASE_PUBLIC_URL_PREFIX}/{path}"
         
-        # Get the public URL for the uploaded file
-        file_url = supabase.storage.from_(bucket_name).get_public_url(f"inference/output_{filename}")
+        # Upload the processed image bytes after the response has been sent
+        background_tasks.add_task(_upload_to_supabase, supabase, SUPABASE_STORAGE_BUCKET, path, image_bytes)
         
         return file_url
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error saving image to Supabase: {str(e)}")
\ No newline at end of file
@@ -1,11 +1,51 @@
+from contextlib import AsyncExitStack, asynccontextmanager
 from fastapi import FastAPI
-from .routers import inference
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
-from fastapi.middleware.cors import CORSMiddleware
 
+# Load .env before importing modules that read configuration at import time
 load_dotenv()
 
-app = FastAPI()
+from .routers import inference
+from .dependencies import (
+    ULTRALYTICS_API_KEY,
+    ULTRALYTICS_MAX_CONCURRENCY,
+    IMAGE_POOL_WORKERS,
+    SUPABASE_URL,
+    SUPABASE_KEY
+)
+from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import httpx
+from supabase import acreate_client
+from concurrent.futures import ThreadPoolExecutor
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Everything registered on the stack is released on shutdown, and also if a
+    # later resource fails to start
+    async with AsyncExitStack() as stack:
+        # One pooled client per process so connections to Ultralytics are reused.
+        # The API key never changes, so it is set once on the client instead of per request.
+        app.state.http_client = await stack.enter_async_context(httpx.AsyncClient(
+            headers={"x-api-key": ULTRALYTICS_API_KEY},
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            http2=True
+        ))
+        # OpenCV decode/draw/encode is CPU-bound, so it runs here instead of on the event loop
+        app.state.image_pool = stack.enter_context(ThreadPoolExecutor(max_workers=IMAGE_POOL_WORKERS))
+        # Bound concurrent Ultralytics calls so bursts queue here instead of hitting rate limits
+        app.state.ultralytics_semaphore = asyncio.Semaphore(ULTRALYTICS_MAX_CONCURRENCY)
+        # A single Supabase client shared by every request; storage is the only
+        # part of it we use, so closing its HTTP session releases its connections
+        app.state.supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+        stack.push_async_callback(app.state.supabase.storage.aclose)
+        yield
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 origins = [
     "http://localhost:3000",
     "https://tisese-routes.vercel.app"
@@ -14,8 +54,10 @@ origins = [
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_methods=["*"],
-    allow_headers=["*"]
+    allow_methods=["POST"],
+    allow_headers=["authorization", "content-type"],
+    # Explicit lists let browsers cache the preflight for a day
+    max_age=86400
 )
 
 app.include_router(inference.router)
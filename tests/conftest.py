@@ -0,0 +1,9 @@
+import os
+
+# app.dependencies reads its configuration at import time
+os.environ.setdefault("ULTRALYTICS_API_KEY", "test-key")
+os.environ.setdefault("ULTRALYTICS_MODEL_URL", "https://hub.ultralytics.com/models/test")
+os.environ.setdefault("ULTRALYTICS_INFERENCE_URL", "https://predict.ultralytics.test/")
+os.environ.setdefault("SUPABASE_URL", "https://supabase.test")
+os.environ.setdefault("SUPABASE_KEY", "test-key")
+os.environ.setdefault("SUPABASE_STORAGE_BUCKET", "test-bucket")
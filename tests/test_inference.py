@@ -0,0 +1,91 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import httpx
+import numpy as np
+import pytest
+from fastapi import HTTPException, UploadFile
+from starlette.datastructures import Headers
+
+from app import dependencies
+
+
+def upload(content: bytes, filename: str = "image.png", content_type: str = "image/png") -> UploadFile:
+    return UploadFile(
+        file=io.BytesIO(content),
+        filename=filename,
+        headers=Headers({"content-type": content_type})
+    )
+
+
+def run_inference(file: UploadFile, handler):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                return await dependencies.run_inference(file, client, pool, asyncio.Semaphore(1))
+
+    return asyncio.run(run())
+
+
+def test_extract_boxes_returns_every_detection():
+    result = {"images": [{"results": [
+        {"box": {"x1": 1.6, "y1": 2, "x2": 10, "y2": 20}},
+        {"box": {"x1": "5", "y1": 6, "x2": 7, "y2": 8}},
+    ]}]}
+    assert dependencies._extract_boxes(result) == [(1, 2, 10, 20), (5, 6, 7, 8)]
+
+
+def test_extract_boxes_skips_malformed_detections():
+    result = {"images": [{"results": [
+        {"name": "no box"},
+        {"box": None},
+        {"box": {"x1": 1, "y1": 2}},
+        {"box": {"x1": "a", "y1": 2, "x2": 3, "y2": 4}},
+        {"box": {"x1": 1, "y1": 2, "x2": 3, "y2": 4}},
+    ]}]}
+    assert dependencies._extract_boxes(result) == [(1, 2, 3, 4)]
+
+
+def test_extract_boxes_without_detections():
+    assert dependencies._extract_boxes({"images": [{"results": []}]}) == []
+    assert dependencies._extract_boxes({"images": [{}]}) == []
+    with pytest.raises(Exception, match="No images"):
+        dependencies._extract_boxes({"images": []})
+
+
+def test_draws_every_box():
+    _, png = cv2.imencode(".png", np.zeros((100, 100, 3), np.uint8))
+
+    def handler(request):
+        return httpx.Response(200, json={"images": [{"results": [
+            {"box": {"x1": 10, "y1": 10, "x2": 30, "y2": 30}},
+            {"box": {"x1": "bad"}},
+            {"box": {"x1": 60, "y1": 60, "x2": 90, "y2": 90}},
+        ]}]})
+
+    result = run_inference(upload(png.tobytes()), handler)
+    image = cv2.imdecode(np.frombuffer(result["image_bytes"], np.uint8), cv2.IMREAD_COLOR)
+    for x, y in [(20, 10), (75, 60)]:
+        blue, green, red = image[y, x]
+        assert green > 150 and blue < 100 and red < 100
+
+
+def test_rejects_non_images_without_calling_ultralytics():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json={})
+
+    with pytest.raises(HTTPException) as exc_info:
+        run_inference(upload(b"not an image", "notes.txt", "text/plain"), handler)
+    assert exc_info.value.status_code == 415
+    assert calls == []
+
+
+@pytest.mark.parametrize("ext", [".jpg", ".png", ".webp"])
+def test_accepts_supported_image_types(ext):
+    _, encoded = cv2.imencode(ext, np.zeros((4, 4, 3), np.uint8))
+    assert dependencies._is_supported_image(encoded.tobytes())
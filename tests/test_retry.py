@@ -0,0 +1,77 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app import dependencies
+from app.dependencies import _retry_delay
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(dependencies, "_retry_delay", lambda attempt, response=None: 0)
+
+
+def post(responses):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        outcome = responses[min(len(calls), len(responses)) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await dependencies._post_with_retries(
+                client, asyncio.Semaphore(1), {"model": "m"}, {"file": ("a.jpg", b"data", "image/jpeg")}
+            )
+
+    return run, calls
+
+
+def test_retries_rate_limit_then_succeeds():
+    run, calls = post([httpx.Response(429), httpx.Response(200, json={"images": []})])
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert len(calls) == 2
+
+
+def test_gives_up_after_max_attempts():
+    run, calls = post([httpx.Response(503)])
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run())
+    assert len(calls) == dependencies.ULTRALYTICS_MAX_ATTEMPTS
+
+
+def test_does_not_retry_client_errors():
+    run, calls = post([httpx.Response(400)])
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run())
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("status_code", [502, 504])
+def test_does_not_retry_gateway_errors(status_code):
+    run, calls = post([httpx.Response(status_code), httpx.Response(200, json={})])
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_retries_connect_errors_but_not_read_errors():
+    run, calls = post([httpx.ConnectError("refused"), httpx.Response(200, json={})])
+    assert asyncio.run(run()).status_code == 200
+    assert len(calls) == 2
+
+    run, calls = post([httpx.ReadTimeout("timed out")])
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_retry_after_is_clamped():
+    assert _retry_delay(0, httpx.Response(429, headers={"retry-after": "-5"})) == 0
+    assert _retry_delay(0, httpx.Response(429, headers={"retry-after": "120"})) == 30
+    assert _retry_delay(0, httpx.Response(429, headers={"retry-after": "2"})) == 2
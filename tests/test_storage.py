@@ -0,0 +1,59 @@
+import asyncio
+import re
+
+import httpx
+from fastapi import BackgroundTasks
+
+from app import dependencies
+
+
+class FakeBucket:
+    def __init__(self, uploads):
+        self.uploads = uploads
+
+    async def upload(self, path, file, file_options):
+        self.uploads.append(path)
+
+
+class FakeStorage:
+    def __init__(self):
+        self.uploads = []
+
+    def from_(self, bucket_name):
+        return FakeBucket(self.uploads)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.storage = FakeStorage()
+
+
+def save(filename):
+    supabase = FakeSupabase()
+    background_tasks = BackgroundTasks()
+
+    async def run():
+        url = await dependencies.save_to_supabase_storage(
+            {"image_bytes": b"jpeg", "filename": filename}, background_tasks, supabase
+        )
+        await background_tasks()
+        return url
+
+    return asyncio.run(run()), supabase.storage.uploads
+
+
+def test_url_matches_upload_path_for_unsafe_filenames():
+    url, uploads = save("my photo #1?v=2%41.png")
+    assert len(uploads) == 1
+    path = uploads[0]
+    assert re.fullmatch(r"inference/[0-9a-f]{32}_[A-Za-z0-9._-]+", path)
+    assert url == f"{dependencies.SUPABASE_PUBLIC_URL_PREFIX}/{path}"
+    # The URL must reach the object unchanged: nothing dropped as a fragment
+    # or query string, nothing percent-decoded by the server
+    assert httpx.URL(url).path.endswith(path)
+
+
+def test_paths_are_unique_per_request():
+    first, _ = save("image.jpg")
+    second, _ = save("image.jpg")
+    assert first != second